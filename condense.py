@@ -1,29 +1,37 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
+import os
 import re
 import shutil
 import subprocess
 import textwrap
-from dataclasses import dataclass, field, replace
-from datetime import timedelta
-from multiprocessing import Pool
+from dataclasses import dataclass, replace
+from operator import attrgetter
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Iterable, cast
+from typing import IO, Iterable, cast
 
-Segment = tuple[str, str]
+Interval = tuple[int, int]
 
 MUSIC_SYMBOLS = ("♬",)
 
+ASS_SUFFIXES = (".ass", ".ssa")
+ASS_OVERRIDE_REGEX = re.compile(r"\{[^}]*\}")
 
-@dataclass(order=True)
+
+@dataclass(slots=True)
 class Subtitle:
     index: int
-    start: timedelta
-    end: timedelta
-    content: str = field(compare=False)
-    proprietary: str = field(default_factory=str, compare=False)
+    start_ms: int
+    end_ms: int
+    content: str
+    proprietary: str = ""
+
+
+class SRTParseError(RuntimeError):
+    pass
 
 
 # from https://github.com/cdown/srt
@@ -39,49 +47,38 @@ class SRT:
             RGX_TIMESTAMP_FIELD_OPTIONAL,
         ]
     )
-    RGX_TIMESTAMP_PARSEABLE = r"^{}$".format(
-        "".join(
-            [
-                RGX_TIMESTAMP_MAGNITUDE_DELIM.join(
-                    ["(" + RGX_TIMESTAMP_FIELD + ")"] * 3
-                ),
-                RGX_TIMESTAMP_MAGNITUDE_DELIM,
-                "?",
-                "(",
-                RGX_TIMESTAMP_FIELD_OPTIONAL,
-                ")",
-            ]
-        )
-    )
     RGX_INDEX = r"-?[0-9]+\.?[0-9]*"
     RGX_PROPRIETARY = r"[^\r\n]*"
     RGX_CONTENT = r".*?"
     RGX_POSSIBLE_CRLF = r"\r?\n"
-    TS_REGEX = re.compile(RGX_TIMESTAMP_PARSEABLE)
-    # noinspection RegExpUnnecessaryNonCapturingGroup
-    SRT_REGEX = re.compile(
+    RGX_SRT = (
         r"\s*(?:({idx})\s*{eof})?({ts}) *-[ -] *> *({ts}) ?({proprietary})(?:{eof}|\Z)({content})"
-        r"(?:{eof}|\Z)(?:{eof}|\Z|(?=(?:{idx}\s*{eof}{ts})))"
-        r"(?=(?:(?:{idx}\s*{eof})?{ts}|\Z))".format(
+        r"(?:{eof}|\Z)(?:{eof}|\Z|(?={idx}\s*{eof}{ts}))"
+        r"(?=(?:{idx}\s*{eof})?{ts}|\Z)".format(
             idx=RGX_INDEX,
             ts=RGX_TIMESTAMP,
             proprietary=RGX_PROPRIETARY,
             content=RGX_CONTENT,
             eof=RGX_POSSIBLE_CRLF,
-        ),
-        re.DOTALL,
+        )
     )
 
-    SECONDS_IN_HOUR = 3600
-    SECONDS_IN_MINUTE = 60
-    HOURS_IN_DAY = 24
-    MICROSECONDS_IN_MILLISECOND = 1000
+    TIMESTAMP_DELIMS_TO_COLON = str.maketrans(dict.fromkeys(",.，．。：", ":"))
+
+    MILLISECONDS_IN_HOUR = 3_600_000
+    MILLISECONDS_IN_MINUTE = 60_000
+    MILLISECONDS_IN_SECOND = 1000
+
+    @classmethod
+    @functools.cache
+    def srt_regex(cls):
+        return re.compile(cls.RGX_SRT, re.DOTALL)
 
     @classmethod
     def parse(cls, srt: str):
         expected_start = 0
 
-        for match in cls.SRT_REGEX.finditer(srt):
+        for match in cls.srt_regex().finditer(srt):
             actual_start = match.start()
             cls._check_contiguity(srt, expected_start, actual_start)
             raw_index, raw_start, raw_end, proprietary, content = match.groups()
@@ -97,8 +94,8 @@ class SRT:
 
             yield Subtitle(
                 index=raw_index,
-                start=cls.srt_timestamp_to_timedelta(raw_start),
-                end=cls.srt_timestamp_to_timedelta(raw_end),
+                start_ms=cls.srt_timestamp_to_milliseconds(raw_start),
+                end_ms=cls.srt_timestamp_to_milliseconds(raw_end),
                 content=content,
                 proprietary=proprietary,
             )
@@ -112,16 +109,17 @@ class SRT:
         cls, subtitles: Iterable[Subtitle], start_index=1, in_place=False, skip=True
     ):
         skipped_subs = 0
-        # noinspection PyTypeChecker
-        for sub_num, subtitle in enumerate(sorted(subtitles), start=start_index):
+        # stable sort keeps file order for subtitles with equal timings
+        subtitles = sorted(subtitles, key=attrgetter("start_ms", "end_ms"))
+        for sub_num, subtitle in enumerate(subtitles, start=start_index):
             if not in_place:
                 subtitle = replace(subtitle)
 
             if skip:
                 if (
                     not subtitle.content.strip()
-                    or subtitle.start < timedelta(0)
-                    or subtitle.start >= subtitle.end
+                    or subtitle.start_ms < 0
+                    or subtitle.start_ms >= subtitle.end_ms
                 ):
                     skipped_subs += 1
                     continue
@@ -131,29 +129,18 @@ class SRT:
             yield subtitle
 
     @classmethod
-    def srt_timestamp_to_timedelta(cls, timestamp: str):
-        match = cls.TS_REGEX.match(timestamp)
-        if match is None:
-            raise RuntimeError(f"Unparseable timestamp: {timestamp}")
-        hours, minutes, seconds, milliseconds = [
-            int(m) if m else 0 for m in match.groups()
-        ]
-        return timedelta(
-            hours=hours, minutes=minutes, seconds=seconds, milliseconds=milliseconds
+    def srt_timestamp_to_milliseconds(cls, timestamp: str):
+        fields = timestamp.translate(cls.TIMESTAMP_DELIMS_TO_COLON).split(":")
+        if len(fields) == 3:
+            fields.append("")
+        hours, minutes, seconds, milliseconds = fields
+        return (
+            int(hours) * cls.MILLISECONDS_IN_HOUR
+            + int(minutes) * cls.MILLISECONDS_IN_MINUTE
+            + int(seconds) * cls.MILLISECONDS_IN_SECOND
+            + int(milliseconds or 0)
         )
 
-    @classmethod
-    def timedelta_to_srt_timestamp(cls, timedelta_timestamp: timedelta):
-        hours, seconds_remainder = divmod(
-            timedelta_timestamp.seconds, cls.SECONDS_IN_HOUR
-        )
-        hours += timedelta_timestamp.days * cls.HOURS_IN_DAY
-        minutes, seconds = divmod(seconds_remainder, cls.SECONDS_IN_MINUTE)
-        milliseconds = (
-            timedelta_timestamp.microseconds // cls.MICROSECONDS_IN_MILLISECOND
-        )
-        return "%02d:%02d:%02d,%03d" % (hours, minutes, seconds, milliseconds)
-
     @staticmethod
     def _check_contiguity(srt: str, expected_start: int, actual_start: int):
         if expected_start != actual_start:
@@ -162,7 +149,81 @@ class SRT:
                 unmatched_content.isspace() or unmatched_content == "\ufeff"
             ):
                 return
-            raise RuntimeError(f"unparseable SRT data: {unmatched_content}")
+            raise SRTParseError(f"unparseable SRT data: {unmatched_content}")
+
+
+def parse_srt_block(block: list[str]) -> Subtitle:
+    raw = "\n".join(block)
+    try:
+        raw_index, timestamps, *content = block
+        raw_start, arrow, rest = timestamps.partition("-->")
+        # a timestamp line in the content means a missing blank line merged
+        # two cues, which only the regex parser can split apart again
+        if not arrow or any("-->" in line for line in content):
+            raise SRTParseError(f"unparseable SRT data: {raw}")
+        raw_end, _, proprietary = rest.strip().partition(" ")
+        return Subtitle(
+            index=int(raw_index.split(".")[0]),
+            start_ms=SRT.srt_timestamp_to_milliseconds(raw_start.strip()),
+            end_ms=SRT.srt_timestamp_to_milliseconds(raw_end),
+            content="\n".join(content),
+            proprietary=proprietary,
+        )
+    except ValueError as error:
+        raise SRTParseError(f"unparseable SRT data: {raw}") from error
+
+
+def parse_srt_fast(lines: Iterable[str]) -> Iterable[Subtitle]:
+    block: list[str] = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line.strip():
+            block.append(line)
+        elif block:
+            yield parse_srt_block(block)
+            block = []
+    if block:
+        yield parse_srt_block(block)
+
+
+def ass_timestamp_to_milliseconds(timestamp: str) -> int:
+    hms, _, fraction = timestamp.strip().partition(".")
+    hours, minutes, seconds = hms.split(":")
+    return (
+        int(hours) * SRT.MILLISECONDS_IN_HOUR
+        + int(minutes) * SRT.MILLISECONDS_IN_MINUTE
+        + int(seconds) * SRT.MILLISECONDS_IN_SECOND
+        + int(fraction.ljust(3, "0")[:3])
+    )
+
+
+def parse_ass(lines: Iterable[str]) -> Iterable[Subtitle]:
+    in_events = False
+    fields: list[str] = []
+    index = 0
+    for line in lines:
+        line = line.strip()
+        if line.startswith("["):
+            in_events = line.lower() == "[events]"
+        elif not in_events:
+            continue
+        elif line.startswith("Format:"):
+            fields = [name.strip().lower() for name in line[7:].split(",")]
+            start, end, text = (fields.index(name) for name in ("start", "end", "text"))
+        elif line.startswith("Dialogue:"):
+            if not fields:
+                raise ValueError("ASS dialogue before events format")
+            values = line[9:].split(",", len(fields) - 1)
+            if len(values) != len(fields):
+                raise ValueError(f"unparseable ASS dialogue: {line}")
+            content = ASS_OVERRIDE_REGEX.sub("", values[text])
+            index += 1
+            yield Subtitle(
+                index=index,
+                start_ms=ass_timestamp_to_milliseconds(values[start]),
+                end_ms=ass_timestamp_to_milliseconds(values[end]),
+                content=content.replace("\\N", "\n").replace("\\n", "\n"),
+            )
 
 
 def filepath(value: str, strict=True):
@@ -171,6 +232,13 @@ def filepath(value: str, strict=True):
     return path
 
 
+def milliseconds(value: str):
+    gap = int(value)
+    if gap < 0:
+        raise argparse.ArgumentTypeError("must not be negative")
+    return gap
+
+
 def parse_args():
     prog = "condense"
     parser = argparse.ArgumentParser(
@@ -217,83 +285,180 @@ def parse_args():
         action="store_true",
         help="Do not try filter out music subtitles",
     )
+    parser.add_argument(
+        "--merge-gap",
+        type=milliseconds,
+        default=250,
+        metavar="MS",
+        help="Merge subtitles less than MS milliseconds apart into one segment. Default to 250",
+    )
     return parser.parse_args()
 
 
+def ffmpeg_command(*args: str) -> list[str]:
+    threads = str(os.cpu_count() or 1)
+    return [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel",
+        "fatal",
+        "-nostats",
+        "-y",
+        "-threads",
+        "0",
+        "-filter_threads",
+        threads,
+        "-filter_complex_threads",
+        threads,
+        *args,
+    ]
+
+
 def call_ffmpeg(*args: str):
-    return subprocess.check_call(
-        ["ffmpeg", "-hide_banner", "-loglevel", "fatal", "-nostats", "-y", *args],
-        stdout=subprocess.DEVNULL,
-    )
+    return subprocess.check_call(ffmpeg_command(*args), stdout=subprocess.DEVNULL)
 
 
-def format_timedelta(timedelta_timestamp: timedelta) -> str:
-    return SRT.timedelta_to_srt_timestamp(timedelta_timestamp).replace(",", ".")
+def coalesce(intervals: Iterable[Interval], gap: int) -> Iterable[Interval]:
+    intervals = sorted(intervals)
+    if not intervals:
+        return
+    merged_start, merged_end = intervals[0]
+    for start, end in intervals[1:]:
+        if start - merged_end < gap:
+            merged_end = max(merged_end, end)
+            continue
+        yield merged_start, merged_end
+        merged_start, merged_end = start, end
+    yield merged_start, merged_end
+
 
+def read_subtitles(subtitles_path: Path) -> list[Subtitle]:
+    if subtitles_path.suffix in ASS_SUFFIXES:
+        try:
+            with subtitles_path.open(encoding="utf-8-sig") as ass_file:
+                return list(parse_ass(ass_file))
+        except ValueError:
+            # leave files the events parser rejects to ffmpeg's converter
+            pass
 
-def parse_srt(subtitles_path: Path, filters: set[str]) -> Iterable[Segment]:
     srt_path = subtitles_path.with_suffix(".srt")
     if subtitles_path.suffix != ".srt":
-        call_ffmpeg("-i", str(subtitles_path), "-c:s", "srt", str(srt_path))
-
-    subs = SRT.parse(srt_path.read_text())
-    for sub in SRT.sort_and_reindex(subs):
-        if filters and any(word in sub.content for word in filters):
+        call_ffmpeg("-i", os.fspath(subtitles_path), "-c:s", "srt", os.fspath(srt_path))
+
+    # stream lines into the line parser instead of reading the whole file
+    with srt_path.open(encoding="utf-8-sig") as srt_file:
+        try:
+            return list(parse_srt_fast(srt_file))
+        except SRTParseError:
+            # blocks the line parser rejects go through the lenient regex parser
+            srt_file.seek(0)
+            return list(SRT.parse(srt_file.read()))
+
+
+def parse_srt(
+    subtitles_path: Path, filters: set[str], merge_gap: int
+) -> Iterable[Interval]:
+    subs = read_subtitles(subtitles_path)
+    filter_regex = re.compile("|".join(map(re.escape, filters))) if filters else None
+    intervals: list[Interval] = []
+    # subs is not reused, so reindex in place instead of copying every subtitle
+    for sub in SRT.sort_and_reindex(subs, in_place=True):
+        if filter_regex and filter_regex.search(sub.content):
             continue
-        yield format_timedelta(sub.start), format_timedelta(sub.end)
+        intervals.append((sub.start_ms, sub.end_ms))
+    yield from coalesce(intervals, merge_gap)
+
+
+def select_filter(intervals: Iterable[Interval]) -> str:
+    terms = [
+        f"between(t,{start / 1000:.3f},{end / 1000:.3f})" for start, end in intervals
+    ]
+    if not terms:
+        raise RuntimeError("no subtitles left to condense")
+    expression = "+".join(terms)
+    return f"aselect='{expression}',asetpts=N/SR/TB"
+
+
+def demux_audio(video_path: Path) -> subprocess.Popen[bytes]:
+    return subprocess.Popen(
+        ffmpeg_command(
+            "-i",
+            os.fspath(video_path),
+            "-map",
+            "0:a",
+            "-c:a",
+            "copy",
+            "-f",
+            "matroska",
+            "pipe:1",
+        ),
+        stdout=subprocess.PIPE,
+    )
 
 
-def extract_segment(segment: Segment, index: int, audio_path: Path) -> Path:
-    dest_path = audio_path.parent.joinpath(f"{index}{audio_path.suffix}")
-    call_ffmpeg(
+def condense_piped(
+    filter_path: Path, demuxer: subprocess.Popen[bytes], output_path: Path
+):
+    select_args = ffmpeg_command(
         "-i",
-        str(audio_path),
-        "-ss",
-        segment[0],
-        "-to",
-        segment[1],
-        "-c",
-        "copy",
-        str(dest_path),
+        "pipe:0",
+        "-vn",
+        "-filter_script:a",
+        os.fspath(filter_path),
+        os.fspath(output_path),
     )
-    return dest_path
+    with demuxer:
+        selector = subprocess.Popen(
+            select_args, stdin=demuxer.stdout, stdout=subprocess.DEVNULL
+        )
+        # let the demuxer receive SIGPIPE if the selector exits early
+        cast(IO[bytes], demuxer.stdout).close()
+        selector.wait()
 
+    for process in (demuxer, selector):
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
 
-def condense(segments: Iterable[Segment], video_path: Path, output_path: Path):
+
+def condense_via_tempfile(filter_path: Path, video_path: Path, output_path: Path):
     with TemporaryDirectory() as tmpdir:
         audio_path = Path(tmpdir).joinpath(video_path.stem + output_path.suffix)
         call_ffmpeg(
             "-i",
-            str(video_path),
+            os.fspath(video_path),
             "-map",
             "0:a",
-            str(audio_path),
+            os.fspath(audio_path),
         )
-
-        with Pool() as pool:
-            segment_paths = pool.starmap(
-                extract_segment,
-                (
-                    (segment, index, audio_path)
-                    for index, segment in enumerate(segments)
-                ),
-            )
-
-        filelist_path = Path(tmpdir).joinpath("filelist.txt")
-        filelist_path.write_text("\n".join(f"file {path}" for path in segment_paths))
         call_ffmpeg(
-            "-f",
-            "concat",
-            "-safe",
-            "0",
             "-i",
-            str(filelist_path),
-            "-c",
-            "copy",
-            str(output_path),
+            os.fspath(audio_path),
+            "-vn",
+            "-filter_script:a",
+            os.fspath(filter_path),
+            os.fspath(output_path),
         )
 
 
+def condense(intervals: Iterable[Interval], video_path: Path, output_path: Path):
+    # intervals are parsed lazily, so start the demuxer first to overlap its
+    # startup and probing with subtitle parsing
+    demuxer = demux_audio(video_path)
+    with TemporaryDirectory() as tmpdir:
+        # long episodes can exceed the argv length limit with an inline filter
+        filter_path = Path(tmpdir).joinpath("filter.txt")
+        try:
+            filter_path.write_text(select_filter(intervals))
+        except BaseException:
+            with demuxer:
+                demuxer.kill()
+            raise
+        try:
+            condense_piped(filter_path, demuxer, output_path)
+        except subprocess.CalledProcessError:
+            condense_via_tempfile(filter_path, video_path, output_path)
+
+
 def find_subtitles(video_path: Path) -> Path:
     valid_suffixes = [".srt", ".ass", ".ssa"]
     for suffix in valid_suffixes:
@@ -320,7 +485,7 @@ def main():
     if not args.skip_filter_music:
         filters.update(MUSIC_SYMBOLS)
 
-    subtitles = parse_srt(subtitles_path, filters)
+    subtitles = parse_srt(subtitles_path, filters, args.merge_gap)
     condense(
         subtitles,
         video_path,